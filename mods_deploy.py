@@ -2,55 +2,77 @@
 
 import sys
 import os
-from happi.containers import registry
-from happi import Client
+from collections import defaultdict
+from functools import lru_cache
+import utils
 from utils import make_Makefile, make_ell_configs, make_qmini_configs
-from pcdsdevices.happi.containers import (Elliptec, Qmini, SmarActMotor,
-                                          SmarActTipTiltMotor, ThorlabsWfs,
-                                          ThorlabsPM101PowerMeter,
-                                          EnvironmentalMonitor, LasBasler)
 
 # dev_map map devices to functions 
 dev_map = {'pcdsdevices.Elliptec': make_ell_configs,
            'pcdsdevices.Qmini': make_qmini_configs}
 
+_registered = False
+
+
+def _register_containers():
+    """
+    Hack our test device types into the happi registry. Only done once per
+    process.
+    """
+    global _registered
+    if _registered:
+        return
+    from happi.containers import registry
+    from pcdsdevices.happi.containers import (Elliptec, Qmini, SmarActMotor,
+                                              SmarActTipTiltMotor,
+                                              ThorlabsWfs,
+                                              ThorlabsPM101PowerMeter,
+                                              EnvironmentalMonitor, LasBasler)
+    containers = {'pcdsdevices.Elliptec': Elliptec,
+                  'pcdsdevices.Qmini': Qmini,
+                  'pcdsdevices.SmarActMotor': SmarActMotor,
+                  'pcdsdevices.SmarActTipTiltMotor': SmarActTipTiltMotor,
+                  'pcdsdevices.LasBasler': LasBasler,
+                  'pcdsdevices.ThorlabsWfs': ThorlabsWfs,
+                  'pcdsdevices.ThorlabsPM101PowerMeter':
+                      ThorlabsPM101PowerMeter,
+                  'pcdsdevices.EnvironmentalMonitor': EnvironmentalMonitor}
+    registry._registry.update(containers)
+    registry._reverse_registry.update({v: k for k, v in containers.items()})
+    _registered = True
+
+
+@lru_cache(maxsize=4)
+def _client(dbpath):
+    """
+    Return a happi Client for the given database, reused across tiles.
+    """
+    # happi is slow to import; only pay for it once we need a client.
+    from happi import Client
+    return Client(path=dbpath)
+
+
 def make_tile_configs(tile, directory, dbpath):
     """
     Write TILE IOC configs based on database entries.
     """
-    # Hack in our test device types
-    registry._registry['pcdsdevices.Elliptec'] = Elliptec
-    registry._reverse_registry[Elliptec] = 'pcdsdevices.Elliptec'
-    registry._registry['pcdsdevices.Qmini'] = Qmini 
-    registry._reverse_registry[Qmini] = 'pcdsdevices.Qmini'
-    registry._registry['pcdsdevices.SmarActMotor'] = SmarActMotor
-    registry._reverse_registry[SmarActMotor] = 'pcdsdevices.SmarActMotor'
-    registry._registry['pcdsdevices.SmarActTipTiltMotor'] = SmarActTipTiltMotor
-    registry._reverse_registry[SmarActTipTiltMotor] = \
-        'pcdsdevices.SmarActTipTiltMotor'
-    registry._registry['pcdsdevices.LasBasler'] = LasBasler
-    registry._reverse_registry[LasBasler] = 'pcdsdevices.LasBasler'
-    registry._registry['pcdsdevices.ThorlabsWfs'] = ThorlabsWfs
-    registry._reverse_registry[ThorlabsWfs] = 'pcdsdevices.ThorlabsWfs'
-    registry._registry['pcdsdevices.ThorlabsPM101PowerMeter'] = \
-        ThorlabsPM101PowerMeter
-    registry._reverse_registry[ThorlabsPM101PowerMeter] = \
-        'pcdsdevices.ThorlabsPM101PowerMeter'
-    registry._registry['pcdsdevices.EnvironmentalMontior'] = \
-        EnvironmentalMonitor 
-    registry._reverse_registry[EnvironmentalMonitor] = \
-        'pcdsdevices.EnvironmentalMonitor'
-
     # Just use our test devices for now
     if tile not in ['lm1k4_com']:
-        raise ValueError("Unrecognized TILE {}".format(tile))
-
-    client = Client(path=dbpath)
-    results = client.search(location_group=tile)
-    for dev in dev_map.keys():  # Aggregate devices based on container type
-        devs = [result for result in results if result['type'] == dev]
-        print("Found {} devices of type {}".format(len(devs), dev))
-        func = dev_map[devs[0]['type']]
+        raise ValueError(f"Unrecognized TILE {tile}")
+
+    _register_containers()
+
+    results = _client(dbpath).search(location_group=tile)
+    # Aggregate devices based on container type in a single pass
+    buckets = defaultdict(list)
+    for result in results:
+        buckets[result['type']].append(result)
+    for dev, func in dev_map.items():
+        devs = buckets.get(dev, [])
+        if utils.VERBOSE:
+            print(f"Found {len(devs)} devices of type {dev}")
+        if not devs:
+            continue
         func(devs, directory)
 
 
@@ -1,20 +1,31 @@
 #!/usr/bin/env python
 
 import os
+from collections import defaultdict
 
-from schema import Schema, And, Use
-from happi import Client
+from schema import Schema, And
+
+# Print progress messages, here and in mods_deploy.make_tile_configs.
+# Library callers generating many configs can set this to False to keep
+# stdout quiet; warnings about skipped devices are always printed.
+VERBOSE = True
+
+# Allowed values for enumerated metadata fields
+_ARCHES = frozenset(('linux-x86', 'linux-x86_64', 'rhel5-x86_64',
+                     'rhel7-x86_64'))
+_HEX_CHANS = frozenset('123456789abcdef')
+_ELL_MODELS = frozenset(('ell6', 'ell9', 'ell14', 'ell18', 'ell20'))
+_EVR_CHANS = frozenset('0123456789ABab')
+_YES_NO = frozenset(('yes', 'no'))
 
 # Base Schema for IOC generation
 # Assumes base pv is given via prefix
-base_ioc_schema = Schema({'ioc_engineer': And(str),
-                          'ioc_release': And(str),
-                          'ioc_location': And(str),
-                          'ioc_arch': And(str, lambda s: s in ('linux-x86',
-                                                           'linux-x86_64',
-                                                           'rhel5-x86_64',
-                                                           'rhel7-x86_64')),
-                          }, ignore_extra_keys=True)
+_base_ioc_fields = {'ioc_engineer': And(str),
+                    'ioc_release': And(str),
+                    'ioc_location': And(str),
+                    'ioc_arch': And(str, lambda s, _S=_ARCHES: s in _S),
+                    }
+base_ioc_schema = Schema(_base_ioc_fields, ignore_extra_keys=True)
 
 
 def make_Makefile(location):
@@ -22,39 +33,49 @@ def make_Makefile(location):
     Write a Makefile for our standard templated IOCs to the specified location.
     The specified directory must already exist. 
     """ 
-    # Check location for ending '/' and remove if it exists
-    while(location.endswith('/')):
-        location = location[:-1]
+    path = os.path.join(location, 'Makefile')
+
+    try:  # Only create the file if it doesn't already exist
+        f = open(path, 'x')
+    except FileExistsError:
+        if not os.path.isfile(path):
+            raise
+        if VERBOSE:
+            print(f"Found Makefile in {location}. Continuing...")
+        return 0
+    with f:
+        f.writelines((
+            "# SLAC PCDS Makefile for building templated IOC instances\n",
+            "IOC_CFG  += $(wildcard *.cfg)\n",
+            "include /reg/g/pcds/controls/macro/RULES_EXPAND\n",
+        ))
+    return 0
 
-    filename = '/Makefile'
 
-    if os.path.isfile(location+filename):
-        # File exists, so return
-        print("Found Makefile in {}. Continuing...".format(location))
-        return 0
-    else: # We need to make the file
-        with open(location+filename, 'w') as f:
-            f.write("# SLAC PCDS Makefile for building templated IOC instances\n")
-            f.write("IOC_CFG  += $(wildcard *.cfg)\n")
-            f.write("include /reg/g/pcds/controls/macro/RULES_EXPAND\n")
-            return 0
-
-ell_schema = Schema({**base_ioc_schema.schema,
+def _write_config(location, filename, lines):
+    """
+    Write the given lines to an IOC configuration file with a single write.
+    """
+    path = os.path.join(location, filename)
+    if VERBOSE:
+        print(f"Writing {path}")
+    with open(path, 'w') as f:
+        f.write(''.join(lines))
+
+
+ell_schema = Schema({**_base_ioc_fields,
                      'ioc_channel': And(str,
-                                    lambda s: s.lower() in ('1', '2', '3', '4',
-                                                            '5', '6', '7', '8',
-                                                            '9', 'a', 'b', 'c',
-                                                            'd', 'e', 'f')),
+                                    lambda s, _S=_HEX_CHANS: s.lower() in _S),
                      'prefix': And(str),
                      'ioc_serial': And(str),
                      'ioc_base': And(str),
                      'ioc_alias': And(str),
                      'ioc_name': And(str),
                      'ioc_model': And(str,
-                                      lambda s: s.lower() in ('ell6', 'ell9',
-                                                              'ell14', 'ell18', 
-                                                              'ell20'))
+                                      lambda s, _S=_ELL_MODELS:
+                                          s.lower() in _S)
                     }, ignore_extra_keys=True)
+_ell_validate = ell_schema.validate
 
 
 def make_ell_config(devices, serial=None, location=None):
@@ -64,7 +85,8 @@ def make_ell_config(devices, serial=None, location=None):
     Arguments
     ---------
     devices : list of happi.SearchResult
-        List of devices from a Happi database search
+        List of devices from a Happi database search, all belonging to the
+        controller with the given serial number.
 
     serial : str
         Serial number for the Elliptec controller. 
@@ -74,78 +96,75 @@ def make_ell_config(devices, serial=None, location=None):
     """
     # Compare given metadata against defined schema. Should help guard against
     # empty or mal-formed entries.
-    valid = []
-    for device in devices:
-        if device['ioc_serial'] == serial:
-            valid.append(ell_schema.validate(device.metadata))
+    valid = [_ell_validate(device.metadata) for device in devices]
     if len(valid) == 0:
-        print("No valid configs for serial {} found".format(serial))
+        print(f"No valid configs for serial {serial} found")
         return 0
 
     # Do some more data validation; check for inconsistencies
-    channels = [d['ioc_channel'] for d in valid]
-    if len(channels) > len(set(channels)):  # Check for duplicates
-        raise ValueError("Multiple identical channels for controller"
-                         " serial number {}".format(serial))
-    common = ['ioc_release', 'ioc_base', 'ioc_arch', 'ioc_name']
-    for field in common:
-        vals = []
-        for v in valid:
-            vals.append(v[field])
-        if len(set(vals)) > 1:
-            err = "Multiple values for field {} detected".format(field)
-            raise ValueError(err)
-
-    # Data seems valid, make the config
-    filename = valid[0]['ioc_name'] + '.cfg'
-    print("Writing {}".format(location+'/'+filename))
-    with open(location+'/'+filename, 'w') as f:
-        f.write("RELEASE={}\n".format(valid[0]['ioc_release']))
-        f.write("ENGINEER={}\n".format(valid[0]['ioc_engineer']))
-        f.write("LOCATION={}\n".format(valid[0]['ioc_location']))
-        f.write("IOC_PV=IOC:{}\n".format(valid[0]['ioc_base']))
-        f.write("ARCH={}\n".format(valid[0]['ioc_arch']))
-        s = 'PORT(BASE="{}",SERIAL="{}",DEBUG=)\n'.format(valid[0]['ioc_base'], 
-                                                        serial)
-        f.write(s)
-
-        for stage in valid:
-            model = stage['ioc_model'].upper()
-            f.write("{}(PORT0,ADDRESS={})\n".format(model, stage['ioc_channel']))
-            if stage['ioc_alias'] is not None:
-                alias_str = 'ALIAS(RECORD="{0}:M{1}",ALIAS="{2}:ELL:M{1}")\n'
-                f.write(alias_str.format(stage['ioc_base'],
-                                         stage['ioc_channel'],
-                                         stage['ioc_alias']))
+    seen = set()
+    for d in valid:  # Check for duplicates
+        channel = d['ioc_channel']
+        if channel in seen:
+            raise ValueError("Multiple identical channels for controller"
+                             f" serial number {serial}")
+        seen.add(channel)
+    common = ('ioc_release', 'ioc_base', 'ioc_arch', 'ioc_name')
+    first = valid[0]
+    for v in valid[1:]:
+        for field in common:
+            if v[field] != first[field]:
+                err = f"Multiple values for field {field} detected"
+                raise ValueError(err)
+
+    # Data seems valid, make the config. Build the whole file in memory so
+    # it goes out in a single write.
+    base = first['ioc_base']
+    lines = [f"RELEASE={first['ioc_release']}\n"
+             f"ENGINEER={first['ioc_engineer']}\n"
+             f"LOCATION={first['ioc_location']}\n"
+             f"IOC_PV=IOC:{base}\n"
+             f"ARCH={first['ioc_arch']}\n"
+             f'PORT(BASE="{base}",SERIAL="{serial}",DEBUG=)\n']
+
+    for stage in valid:
+        model = stage['ioc_model'].upper()
+        channel = stage['ioc_channel']
+        lines.append(f"{model}(PORT0,ADDRESS={channel})\n")
+        if stage['ioc_alias'] is not None:
+            lines.append(f'ALIAS(RECORD="{stage["ioc_base"]}:M{channel}",'
+                         f'ALIAS="{stage["ioc_alias"]}:ELL:M{channel}")\n')
+
+    _write_config(location, first['ioc_name'] + '.cfg', lines)
     return 0
 
 
 def make_ell_configs(devices, location):
     """
     Function to make all Elliptec configurations found in the given device
-    list. Searches through the data for unique serial numbers, then calls
-    make_elliptec_config for each unique serial number found.
+    list. Groups the devices by serial number, then calls make_ell_config
+    for each unique serial number found.
     """
-    serials = []
+    groups = defaultdict(list)
     for device in devices:
-        serials.append(device['ioc_serial'])
-    for serial in set(serials):
-        print("Writting elliptec configurations to {}".format(location))
-        make_ell_config(devices, serial=serial, location=location)
+        groups[device['ioc_serial']].append(device)
+    if VERBOSE:
+        print(f"Writing elliptec configurations to {location}")
+    for serial, group in groups.items():
+        make_ell_config(group, serial=serial, location=location)
 
 
-qmini_schema = Schema({**base_ioc_schema.schema,
+qmini_schema = Schema({**_base_ioc_fields,
                        'prefix': And(str),
                        'ioc_serial': And(str),
                        'ioc_name': And(str),
-                       'ioc_use_evr': And(str, Use(str.lower),
-                                          lambda s: s in ('yes', 'no')),
-                       'ioc_evr_channel': And(str, Use(str.upper),
-                                             lambda s: s in ('0', '1', '2',
-                                                             '3', '4', '5', 
-                                                             '6', '7', '8',
-                                                             '9', 'A', 'B')),
+                       'ioc_use_evr': And(str,
+                                          lambda s, _S=_YES_NO:
+                                              s.lower() in _S),
+                       'ioc_evr_channel': And(str,
+                                             lambda s, _S=_EVR_CHANS: s in _S),
                       }, ignore_extra_keys=True)
+_qmini_is_valid = qmini_schema.is_valid
 
 
 def make_qmini_config(device, location=None):
@@ -163,27 +182,27 @@ def make_qmini_config(device, location=None):
     """
     # Compare given metadata against defined schema. Should help guard against
     # empty or mal-formed entries.
-    if not qmini_schema.is_valid(device.metadata):
-        print("Device config for {} is not valid".format(device['name']))
+    md = device.metadata
+    if not _qmini_is_valid(md):
+        print(f"Device config for {md['name']} is not valid")
         return 0
 
     ## Data seems valid, make the config
-    filename = device['ioc_name'] + '.cfg'
-    print("Writing {}".format(location+'/'+filename))
-    with open(location+'/'+filename, 'w') as f:
-        f.write("RELEASE={}\n".format(device['ioc_release']))
-        f.write("ARCH={}\n".format(device['ioc_arch']))
-        f.write("ENGINEER={}\n".format(device['ioc_engineer']))
-        f.write("NAME={}\n".format(device['prefix']))
-        f.write("SERIAL={}\n".format(device['ioc_serial']))
-        f.write("LOCATION={}\n".format(device['ioc_location']))
-        f.write("IOCPVROOT=IOC:{}\n".format(device['prefix']))
-        f.write("DEBUG=\n")
-        if device['ioc_use_evr'] == 'yes':
-            f.write("EVR_PV=EVR:{}\n".format(device['prefix']))
-            f.write("EVR_TYPE=SLAC\n")
-            f.write("EVR_TRIG={}\n".format(device['ioc_evr_channel']))
-            
+    lines = []
+    lines.append(f"RELEASE={md['ioc_release']}\n")
+    lines.append(f"ARCH={md['ioc_arch']}\n")
+    lines.append(f"ENGINEER={md['ioc_engineer']}\n")
+    lines.append(f"NAME={md['prefix']}\n")
+    lines.append(f"SERIAL={md['ioc_serial']}\n")
+    lines.append(f"LOCATION={md['ioc_location']}\n")
+    lines.append(f"IOCPVROOT=IOC:{md['prefix']}\n")
+    lines.append("DEBUG=\n")
+    if md['ioc_use_evr'].lower() == 'yes':
+        lines.append(f"EVR_PV=EVR:{md['prefix']}\n")
+        lines.append("EVR_TYPE=SLAC\n")
+        lines.append(f"EVR_TRIG={md['ioc_evr_channel']}\n")
+
+    _write_config(location, md['ioc_name'] + '.cfg', lines)
     return 0
 
 def make_qmini_configs(devices, location):
@@ -191,6 +210,7 @@ def make_qmini_configs(devices, location):
     Function to make all Qmini configurations found in the given device
     list. 
     """
+    if VERBOSE:
+        print(f"Writing qmini configurations to {location}")
     for device in devices:
-        print("Writting qmini configurations to {}".format(location))
         make_qmini_config(device, location=location)